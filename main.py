@@ -9,34 +9,68 @@ Updated: 2025 (LangChain 1.0.3 compatibility)
 """
 
 import os
+import asyncio
+import atexit
+import hashlib
+import json
 import logging
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+from functools import lru_cache
+from pathlib import Path
+
+import httpx
+import numpy as np
 from dotenv import load_dotenv
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
 
 # ---------- VERSION CHECK ----------
 import langchain
 print(f"LangChain version: {langchain.__version__}")
 
 # ---------- BASIC IMPORTS ----------
+from langchain_core.caches import InMemoryCache
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.tools import Tool
 from langchain_core.prompts import PromptTemplate
 
 # Use langchain-ollama for proper tool support
 try:
-    from langchain_ollama import ChatOllama, OllamaEmbeddings
+    from langchain_ollama import ChatOllama
     print("✓ Using langchain-ollama (recommended)")
 except ImportError:
     print("⚠️  langchain-ollama not found. Installing it now...")
     import subprocess
     import sys
     subprocess.check_call([sys.executable, "-m", "pip", "install", "langchain-ollama"])
-    from langchain_ollama import ChatOllama, OllamaEmbeddings
+    from langchain_ollama import ChatOllama
     print("✓ langchain-ollama installed successfully")
 
 
+# HTTP/2 for the shared Ollama client needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    print("⚠️  h2 not installed, Ollama calls will use HTTP/1.1 keep-alive")
+    print("   For HTTP/2 run: pip install 'httpx[http2]'")
+    HTTP2_AVAILABLE = False
+
+from langchain_community.cache import SQLiteCache
 from langchain_community.vectorstores.pgvector import PGVector
-from langchain_community.utilities import SQLDatabase
 from langchain_community.document_loaders import TextLoader 
 from langchain_text_splitters import RecursiveCharacterTextSplitter 
+import sqlglot
+from sqlglot import exp
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
 
 
 # ---------- LANGGRAPH AGENT IMPORTS ----------
@@ -69,6 +103,32 @@ OLLAMA_HOST = os.getenv("OLLAMA_HOST")
 OLLAMA_PORT = os.getenv("OLLAMA_PORT")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
 OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL")
+
+# Optional Infinity / TEI embedding server; Ollama is used when unset
+INFINITY_URL = os.getenv("INFINITY_URL")
+INFINITY_MODEL = os.getenv("INFINITY_MODEL", "mixedbread-ai/mxbai-embed-large-v1")
+
+# Chunks fetched per knowledge-base lookup
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", "3"))
+# Large retrievals are re-ranked by token overlap and cut to this many chunks
+KB_RERANK_TOP_N = int(os.getenv("KB_RERANK_TOP_N", "16"))
+
+# Upper bound on agent graph steps (LLM + tool nodes) per query
+AGENT_RECURSION_LIMIT = int(os.getenv("AGENT_RECURSION_LIMIT", "10"))
+
+# Optional on-disk LLM response cache; in-memory only when unset
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+
+# HNSW tuning: leave unset to let configure_hnsw_params() size the index
+HNSW_M = os.getenv("HNSW_M")
+HNSW_EF_CONSTRUCTION = os.getenv("HNSW_EF_CONSTRUCTION")
+HNSW_EF_SEARCH = os.getenv("HNSW_EF_SEARCH")
+HNSW_MAINTENANCE_WORK_MEM = os.getenv("HNSW_MAINTENANCE_WORK_MEM", "2GB")
+HNSW_MAINTENANCE_WORKERS = int(os.getenv("HNSW_MAINTENANCE_WORKERS", "7"))
+
+# "binary": HNSW over 1-bit quantized vectors, re-ranked by exact halfvec
+# distance; "none": HNSW over the halfvec column itself
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "binary")
 if not all([DB_HOST, DB_USER, DB_PASSWORD, DB_NAME]):
     raise RuntimeError(
         "Missing required DB credentials. "
@@ -76,27 +136,333 @@ if not all([DB_HOST, DB_USER, DB_PASSWORD, DB_NAME]):
     )
 
 CONNECTION_STRING = (
-    f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+PG_CONNINFO = make_conninfo(
+    host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME
 )
 OLLAMA_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
 
 logger.info(f"DB URL: {CONNECTION_STRING}")
 logger.info(f"Ollama URL: {OLLAMA_URL}")
 
-# ---------- EMBEDDINGS & LLM ----------
-# Using langchain-ollama for proper tool binding support
-embedding_model = OllamaEmbeddings(
-    model=OLLAMA_EMBED_MODEL,
-    base_url=OLLAMA_URL,
+# ---------- HTTP CLIENT ----------
+# One keep-alive connection pool shared by every Ollama call (chat and
+# embeddings), so ReAct round-trips don't pay a TCP handshake each time.
+_OLLAMA_TIMEOUT = httpx.Timeout(300.0, connect=10.0)
+_OLLAMA_LIMITS = httpx.Limits(
+    max_keepalive_connections=40,
+    max_connections=100,
+    keepalive_expiry=30.0,
+)
+_OLLAMA_TRANSPORT = httpx.HTTPTransport(
+    retries=3, http2=HTTP2_AVAILABLE, limits=_OLLAMA_LIMITS
 )
+_OLLAMA_ASYNC_TRANSPORT = httpx.AsyncHTTPTransport(
+    retries=3, http2=HTTP2_AVAILABLE, limits=_OLLAMA_LIMITS
+)
+_OLLAMA_CLIENT = httpx.Client(transport=_OLLAMA_TRANSPORT, timeout=_OLLAMA_TIMEOUT)
+atexit.register(_OLLAMA_CLIENT.close)
+
+# ---------- EMBEDDINGS & LLM ----------
+def _to_half(vectors: list) -> list:
+    """Round embeddings to float16 so they match the halfvec column exactly."""
+    return np.asarray(vectors, dtype=np.float16).astype(float).tolist()
+
+
+def _halfvec_literal(vector: list[float]) -> str:
+    """Format an embedding as pgvector text ('[...]'), rounded to float16."""
+    values = ",".join(str(x) for x in np.asarray(vector, dtype=np.float16))
+    return f"[{values}]"
+
+
+class BatchedOllamaEmbeddings(Embeddings):
+    """
+    Embeddings client for Ollama's batch ``/api/embed`` endpoint.
+
+    embed_documents sends every text in a single request. Concurrent
+    embed_query calls (e.g. parallel tool calls in the ReAct loop) are
+    coalesced for a short window and embedded in one request as well.
+    Vectors are returned rounded to float16.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        base_url: str,
+        client: httpx.Client | None = None,
+        batch_window: float = 0.005,
+    ):
+        self.model = model
+        self.base_url = base_url
+        self.batch_window = batch_window
+        self._client = client or httpx.Client(timeout=_OLLAMA_TIMEOUT)
+        self._pending: queue.Queue = queue.Queue()
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        """POST texts to /api/embed, falling back to the legacy endpoint."""
+        response = self._client.post(
+            f"{self.base_url}/api/embed",
+            json={"model": self.model, "input": texts},
+        )
+        embeddings = None
+        if response.status_code != 404:
+            response.raise_for_status()
+            embeddings = response.json().get("embeddings")
+
+        if not embeddings or len(embeddings) != len(texts):
+            # Older Ollama servers only know the one-text-per-call endpoint
+            embeddings = []
+            for text in texts:
+                response = self._client.post(
+                    f"{self.base_url}/api/embeddings",
+                    json={"model": self.model, "prompt": text},
+                )
+                response.raise_for_status()
+                embeddings.append(response.json()["embedding"])
+
+        return _to_half(embeddings)
+
+    def _run_batcher(self) -> None:
+        """Drain queued queries in batches, one request per batch window."""
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.batch_window
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Drop callers that were cancelled (e.g. an aembed_query task);
+            # the rest are marked running and can no longer be cancelled
+            batch = [
+                (text_, future)
+                for text_, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+
+            try:
+                vectors = self._embed([text for text, _ in batch])
+            except Exception as exc:
+                results = [exc] * len(batch)
+            else:
+                # Never leave a caller blocked on a future nobody will resolve
+                short = RuntimeError(
+                    f"Ollama returned {len(vectors)} embeddings "
+                    f"for {len(batch)} inputs"
+                )
+                results = vectors + [short] * (len(batch) - len(vectors))
+
+            for (_, future), result in zip(batch, results):
+                try:
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                except InvalidStateError:
+                    # One bad future must not end the batcher thread
+                    logger.warning("⚠️  Dropped an embedding for a settled future")
+
+    def _submit(self, text: str) -> Future:
+        with self._batcher_lock:
+            if self._batcher is None:
+                self._batcher = threading.Thread(
+                    target=self._run_batcher, name="embed-batcher", daemon=True
+                )
+                self._batcher.start()
+        future: Future = Future()
+        self._pending.put((text, future))
+        return future
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._submit(text).result(timeout=_OLLAMA_TIMEOUT.read)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await asyncio.wrap_future(self._submit(text))
+
+
+class InfinityEmbeddings(Embeddings):
+    """
+    Embeddings client for an Infinity or Text-Embeddings-Inference server,
+    using its OpenAI-compatible ``/embeddings`` endpoint.
+
+    The server batches concurrent requests itself, so queries are sent as
+    they arrive. Vectors are returned rounded to float16.
+    """
+
+    def __init__(self, model: str, base_url: str, client: httpx.Client | None = None):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self._client = client or httpx.Client(timeout=_OLLAMA_TIMEOUT)
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        response = self._client.post(
+            f"{self.base_url}/embeddings",
+            json={"input": texts, "model": self.model},
+        )
+        response.raise_for_status()
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        return _to_half([item["embedding"] for item in data])
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+
+embedding_model = None
+if INFINITY_URL:
+    try:
+        embedding_model = InfinityEmbeddings(
+            model=INFINITY_MODEL,
+            base_url=INFINITY_URL,
+            client=_OLLAMA_CLIENT,
+        )
+        embedding_model.embed_query("ping")
+        logger.info(f"✓ Using Infinity embeddings at {INFINITY_URL}")
+    # HTTPError also covers status errors: a 404 from a TEI URL missing
+    # /v1, or a 503 while the container is still loading its model
+    except (ConnectionError, httpx.HTTPError) as exc:
+        logger.warning(f"⚠️  Infinity unavailable ({exc}), using Ollama embeddings")
+        embedding_model = None
+
+if embedding_model is None:
+    embedding_model = BatchedOllamaEmbeddings(
+        model=OLLAMA_EMBED_MODEL,
+        base_url=OLLAMA_URL,
+        client=_OLLAMA_CLIENT,
+    )
+
+# temperature=0 makes completions deterministic, so identical
+# (messages, tools) calls in the ReAct loop can be served from the cache.
+# The cache key covers the serialized messages plus the model parameters,
+# which include the bound tool schemas.
+if LLM_CACHE_PATH:
+    llm_cache = SQLiteCache(database_path=LLM_CACHE_PATH)
+else:
+    # FIFO eviction, no TTL: InMemoryCache supports neither LRU nor expiry
+    llm_cache = InMemoryCache(maxsize=512)
 
 # ChatOllama from langchain-ollama supports tool binding
 llm = ChatOllama(
     model=OLLAMA_MODEL,
     base_url=OLLAMA_URL,
     temperature=0,
+    cache=llm_cache,
+    client_kwargs={"timeout": _OLLAMA_TIMEOUT},
+    sync_client_kwargs={"transport": _OLLAMA_TRANSPORT},
+    async_client_kwargs={"transport": _OLLAMA_ASYNC_TRANSPORT},
 )
 
+# ---------- DEMO QUERIES ----------
+DEMO_QUERIES = [
+    "List all Samsung desktops released after 2021 with more than 8 CPU cores "
+    "and a price under 1500 USD.",
+    "Explain what CPU tier means in this dataset and how it affects performance.",
+    "What are the top 3 most affordable laptops with at least 16GB RAM "
+    "and explain what makes a good CPU for laptops?",
+]
+
+_Q_CACHE_PATH = Path(".cache/query_embeds.npz")
+
+
+@lru_cache(maxsize=1)
+def load_demo_query_embeds() -> dict[str, list[float]]:
+    """
+    Load the embeddings of DEMO_QUERIES from disk, embedding them once on
+    the first call (or when the queries or embedding model change).
+
+    Returns:
+        Mapping of demo query text to its embedding
+    """
+    model = getattr(embedding_model, "model", "")
+    embeds = None
+    try:
+        with np.load(_Q_CACHE_PATH) as cached:
+            if (
+                cached["model"].item() == model
+                and cached["queries"].tolist() == DEMO_QUERIES
+            ):
+                embeds = cached["embeds"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    if embeds is None:
+        embeds = np.asarray(
+            embedding_model.embed_documents(DEMO_QUERIES), dtype=np.float32
+        )
+        _Q_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            _Q_CACHE_PATH,
+            model=np.array(model),
+            queries=np.array(DEMO_QUERIES),
+            embeds=embeds,
+        )
+
+    return dict(zip(DEMO_QUERIES, embeds.tolist()))
+
+
+def demo_query_embed(question: str) -> list[float] | None:
+    """
+    Cached embedding for a verbatim demo query, or None.
+
+    Only the no-agent fallback passes the demo prompt through unchanged;
+    the ReAct agent rephrases it, so the agent path never calls this.
+    """
+    if question not in DEMO_QUERIES:
+        return None
+    try:
+        return load_demo_query_embeds()[question]
+    except Exception as exc:
+        logger.warning(f"⚠️  Could not load demo query embeddings: {exc}")
+        return None
+
+# ---------- DB ENGINE ----------
+# Serves PGVector and the startup DDL only; the SQL tool has its own
+# async pool, so this just covers a couple of threaded retrievals
+DB_POOL_SIZE = 2
+
+engine = create_engine(
+    CONNECTION_STRING,
+    poolclass=QueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=2,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+
+
+def warm_pool(size: int = DB_POOL_SIZE) -> None:
+    """Open ``size`` pooled connections up front so tool calls skip auth."""
+    connections = [engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.execute(text("SELECT 1"))
+    for connection in connections:
+        connection.close()
+
+
 # ---------- PGVector ----------
 loader = TextLoader("comprice_docs.txt", encoding="utf-8")
 documents = loader.load()
@@ -104,8 +470,115 @@ text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
 docs = text_splitter.split_documents(documents)
 
 
-vectorstore = PGVector(
+def ef_search_for_k(k: int, floor: int = 40) -> int:
+    """
+    Pick hnsw.ef_search for a query: cheap for short lookups, wider for big k,
+    never below the collection's configured floor.
+    """
+    return max(floor, min(200, 10 * k) if k >= 5 else 40)
+
+
+class HnswPGVector(PGVector):
+    """
+    PGVector whose searches run against the HNSW index from
+    ensure_hnsw_index, with hnsw.ef_search set per query.
+
+    Each search runs in its own transaction with ``SET LOCAL``-scoped
+    ef_search, so low-recall lookups traverse less of the graph than
+    explanatory ones; ``ef_search_floor`` (from configure_hnsw_params)
+    keeps large collections from dropping below their recall target.
+    When the index is binary-quantized, candidates come from
+    ``binary_quantize(embedding)`` (1 bit per dimension, Hamming distance)
+    and the best ``k`` are re-ranked by exact cosine distance on the
+    halfvec column. Until ``index_dim`` is set, or when a metadata filter
+    is given, the stock LangChain query is used.
+    """
+
+    rerank_factor = 10
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index_dim: int | None = None
+        self.quantized = False
+        self.ef_search_floor = 40
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: dict | None = None,
+        ef_search: int | None = None,
+    ) -> list[tuple[Document, float]]:
+        if filter or self.index_dim is None:
+            return super().similarity_search_with_score_by_vector(
+                embedding, k=k, filter=filter
+            )
+
+        ef_search = ef_search or ef_search_for_k(k, self.ef_search_floor)
+        candidates = k
+        if self.quantized:
+            candidates = k * self.rerank_factor
+            # HNSW never returns more than ef_search rows
+            ef_search = max(ef_search, candidates)
+
+        query = _halfvec_literal(embedding)
+        with self._make_session() as session, session.begin():
+            collection = self.get_collection(session)
+            # The collection id is inlined rather than bound so the partial
+            # index predicate still matches under a generic (prepared) plan
+            where = f"WHERE collection_id = '{collection.uuid}'"
+            if self.quantized:
+                sql = (
+                    "SELECT document, cmetadata, "
+                    "  embedding <=> CAST(:query AS halfvec) AS distance "
+                    "FROM ("
+                    "  SELECT document, cmetadata, embedding "
+                    f"  FROM langchain_pg_embedding {where} "
+                    f"  ORDER BY binary_quantize(embedding)::bit({self.index_dim}) "
+                    "    <~> binary_quantize(CAST(:query AS halfvec)) "
+                    "  LIMIT :candidates"
+                    ") AS candidates "
+                    "ORDER BY distance LIMIT :k"
+                )
+            else:
+                sql = (
+                    "SELECT document, cmetadata, "
+                    "  embedding <=> CAST(:query AS halfvec) AS distance "
+                    f"FROM langchain_pg_embedding {where} "
+                    "ORDER BY distance LIMIT :k"
+                )
+
+            # set_config(..., true) is SET LOCAL: reverts when the transaction ends
+            session.execute(
+                text("SELECT set_config('hnsw.ef_search', :ef, true)"),
+                {"ef": str(min(ef_search, 1000))},
+            )
+            rows = session.execute(
+                text(sql),
+                {"query": query, "candidates": candidates, "k": k},
+            ).all()
+
+        return [
+            (Document(page_content=row.document, metadata=row.cmetadata), row.distance)
+            for row in rows
+        ]
+
+    def similarity_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: dict | None = None,
+        **kwargs,
+    ) -> list[Document]:
+        docs_and_scores = self.similarity_search_with_score_by_vector(
+            embedding, k=k, filter=filter, ef_search=kwargs.get("ef_search")
+        )
+        return [doc for doc, _ in docs_and_scores]
+
+
+vectorstore = HnswPGVector(
     connection_string=CONNECTION_STRING,
+    connection=engine,
     collection_name="comprice_docs",
     embedding_function=embedding_model,
 )
@@ -124,64 +597,539 @@ except:
     logger.info("Initializing vector store with documents...")
     vectorstore.add_documents(docs)
 
-retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+
+# ---------- HNSW INDEX ----------
+HNSW_INDEX_NAME = "comprice_docs_hnsw"
+BQ_INDEX_NAME = "comprice_docs_bq_hnsw"
+
+
+def configure_hnsw_params(vector_count: int) -> dict:
+    """
+    Pick HNSW build and search parameters for a collection size.
+
+    Small collections get a cheap graph; larger ones trade build time
+    and memory for recall. HNSW_M, HNSW_EF_CONSTRUCTION and
+    HNSW_EF_SEARCH override the automatic choice.
+
+    Args:
+        vector_count: Number of embeddings in the collection
+
+    Returns:
+        Dict with "m", "ef_construction" and "ef_search"
+    """
+    if vector_count < 100_000:
+        m, ef_construction, ef_search = 16, 64, 40
+    elif vector_count < 1_000_000:
+        m, ef_construction, ef_search = 24, 128, 100
+    else:
+        m, ef_construction, ef_search = 32, 200, 200
+
+    return {
+        "m": int(HNSW_M or m),
+        "ef_construction": int(HNSW_EF_CONSTRUCTION or ef_construction),
+        "ef_search": int(HNSW_EF_SEARCH or ef_search),
+    }
+
+
+def ensure_hnsw_index(store: HnswPGVector) -> dict:
+    """
+    Store the collection as halfvec, build an HNSW index over it and set
+    the store's ef_search floor, so retrieval stops doing exact scans and
+    reads half the bytes per vector.
+
+    With VECTOR_QUANTIZATION=binary the index is built over
+    ``binary_quantize(embedding)`` (bit_hamming_ops), 16x smaller than the
+    halfvec graph, and the store re-ranks its candidates. Otherwise the
+    index uses halfvec_cosine_ops directly.
+
+    LangChain creates the embedding column as untyped FP32 ``vector``; it
+    is migrated to ``halfvec(<dim>)`` first (all collections in the table
+    must share the dimension). Requires pgvector >= 0.7.
+
+    The index definition is stored as the index's comment. An index whose
+    comment differs (new collection uuid, new HNSW_M / ef_construction or
+    size tier, or one built before this check) is dropped and rebuilt.
+
+    Args:
+        store: The PGVector store backing the knowledge base
+
+    Returns:
+        The HNSW parameters in use, or an empty dict if nothing to index
+    """
+    with store._make_session() as session, session.begin():
+        collection = store.get_collection(session)
+        vector_count, dim = session.execute(
+            text(
+                "SELECT count(*), max(vector_dims(embedding)) "
+                "FROM langchain_pg_embedding WHERE collection_id = :cid"
+            ),
+            {"cid": collection.uuid},
+        ).one()
+        if not vector_count:
+            return {}
+
+        params = configure_hnsw_params(vector_count)
+
+        column_type = session.execute(
+            text(
+                "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                "WHERE attrelid = 'langchain_pg_embedding'::regclass "
+                "AND attname = 'embedding'"
+            )
+        ).scalar()
+        if column_type != f"halfvec({dim})":
+            logger.info(f"Migrating embedding column to halfvec({dim})...")
+            # Indexes built for vector ops cannot survive the type change
+            session.execute(text(f"DROP INDEX IF EXISTS {HNSW_INDEX_NAME}"))
+            session.execute(text(f"DROP INDEX IF EXISTS {BQ_INDEX_NAME}"))
+            session.execute(
+                text(
+                    "ALTER TABLE langchain_pg_embedding "
+                    f"ALTER COLUMN embedding TYPE halfvec({dim}) "
+                    f"USING embedding::halfvec({dim})"
+                )
+            )
+
+        session.execute(
+            text(f"SET LOCAL maintenance_work_mem = '{HNSW_MAINTENANCE_WORK_MEM}'")
+        )
+        session.execute(
+            text(
+                "SET LOCAL max_parallel_maintenance_workers = "
+                f"{HNSW_MAINTENANCE_WORKERS}"
+            )
+        )
+        if VECTOR_QUANTIZATION == "binary":
+            index_name = BQ_INDEX_NAME
+            index_column = f"(binary_quantize(embedding)::bit({dim})) bit_hamming_ops"
+        else:
+            index_name = HNSW_INDEX_NAME
+            index_column = "embedding halfvec_cosine_ops"
+        definition = (
+            f"ON langchain_pg_embedding USING hnsw ({index_column}) "
+            f"WITH (m = {params['m']}, "
+            f"ef_construction = {params['ef_construction']}) "
+            f"WHERE collection_id = '{collection.uuid}'"
+        )
+        built = session.execute(
+            text("SELECT obj_description(to_regclass(:name), 'pg_class')"),
+            {"name": index_name},
+        ).scalar()
+        if built != definition:
+            logger.info(f"Building HNSW index {index_name}...")
+            session.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            session.execute(text(f"CREATE INDEX {index_name} {definition}"))
+            comment = definition.replace("'", "''")
+            session.execute(text(f"COMMENT ON INDEX {index_name} IS '{comment}'"))
+
+    store.ef_search_floor = params["ef_search"]
+    store.index_dim = dim
+    store.quantized = VECTOR_QUANTIZATION == "binary"
+    return {**params, "quantization": VECTOR_QUANTIZATION}
+
+
+try:
+    hnsw_params = ensure_hnsw_index(vectorstore)
+    if hnsw_params:
+        logger.info(f"✓ HNSW index ready: {hnsw_params}")
+except Exception as exc:
+    logger.warning(f"⚠️  Could not build HNSW index, using exact scan: {exc}")
+
+# ef_search is left to the store so the collection's floor applies
+RETRIEVER_SEARCH_KWARGS = {"k": RETRIEVER_K}
+
+# Separator between retrieved chunks in the knowledge-base tool output
+_SEP = "\n\n---\n\n"
+
+
+# ---------- RE-RANKING ----------
+# Below this many chunks the JIT warm-up costs more than it saves
+KB_RERANK_MIN_DOCS = 64
+
+_TOKEN = re.compile(r"\w+")
+
+
+def _token_hashes(text_: str) -> np.ndarray:
+    """Sorted unique crc32 hashes of the lower-cased word tokens in text."""
+    return np.unique(
+        np.fromiter(
+            (zlib.crc32(token.encode()) for token in _TOKEN.findall(text_.lower())),
+            dtype=np.int64,
+        )
+    )
+
+
+@lru_cache(maxsize=1)
+def _jaccard_kernel():
+    """
+    Build the scoring kernel on first use, so runs that never re-rank
+    (the default RETRIEVER_K is far below KB_RERANK_MIN_DOCS) don't pay
+    for importing numba. Without numba the same loop runs in plain Python.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        logger.warning(
+            "⚠️  numba not installed, re-ranking in pure Python "
+            "(pip install numba for the JIT kernel)"
+        )
+        prange = range
+
+        def njit(*args, **kwargs):
+            return lambda func: func
+
+    @njit(parallel=True, cache=True)
+    def _jaccard_scores(tokens, offsets, query):
+        """
+        Jaccard overlap between each chunk's token set and the query's.
+
+        Args:
+            tokens: Concatenated sorted unique token hashes of all chunks
+            offsets: Chunk i owns tokens[offsets[i]:offsets[i + 1]]
+            query: Sorted unique token hashes of the question
+
+        Returns:
+            float32 array with one score per chunk
+        """
+        n = len(offsets) - 1
+        scores = np.zeros(n, dtype=np.float32)
+        for i in prange(n):
+            a, end = offsets[i], offsets[i + 1]
+            b = 0
+            shared = 0
+            while a < end and b < len(query):
+                if tokens[a] == query[b]:
+                    shared += 1
+                    a += 1
+                    b += 1
+                elif tokens[a] < query[b]:
+                    a += 1
+                else:
+                    b += 1
+            union = (offsets[i + 1] - offsets[i]) + len(query) - shared
+            if union > 0:
+                scores[i] = shared / union
+        return scores
+
+    return _jaccard_scores
+
+
+def rerank_by_overlap(question: str, docs: list[Document]) -> list[Document]:
+    """
+    Dedupe retrieved chunks, order them by token overlap with the question
+    and keep the best KB_RERANK_TOP_N. Ties keep their vector-search order.
+
+    Args:
+        question: The knowledge-base question
+        docs: Chunks in vector-similarity order
+
+    Returns:
+        The re-ranked, truncated chunks
+    """
+    seen = set()
+    unique_docs = []
+    for doc in docs:
+        if doc.page_content not in seen:
+            seen.add(doc.page_content)
+            unique_docs.append(doc)
+
+    chunk_tokens = [_token_hashes(doc.page_content) for doc in unique_docs]
+    offsets = np.zeros(len(chunk_tokens) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(tokens) for tokens in chunk_tokens])
+    scores = _jaccard_kernel()(
+        np.concatenate(chunk_tokens), offsets, _token_hashes(question)
+    )
+    order = np.argsort(-scores, kind="stable")[:KB_RERANK_TOP_N]
+    return [unique_docs[i] for i in order]
+
+
+# ---------- KNOWLEDGE CACHE ----------
+class KnowledgeCache:
+    """
+    In-memory read-through cache in front of the knowledge-base retriever.
+
+    Exact repeats are found by a blake2b digest of the question. On a miss
+    the question's embedding is compared with those of the cached questions
+    and a near-duplicate (cosine >= ``threshold``) is served instead of
+    querying pgvector. Least recently used entries are evicted past
+    ``maxsize``.
+    """
+
+    def __init__(self, maxsize: int = 1024, threshold: float = 0.98):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._entries: OrderedDict[str, tuple[np.ndarray, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(question: str) -> str:
+        return hashlib.blake2b(question.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get_similar(self, vector: list[float]) -> str | None:
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            if not self._entries:
+                return None
+            keys = list(self._entries)
+            matrix = np.stack([unit for unit, _ in self._entries.values()])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]][1]
+
+    def put(self, key: str, vector: list[float], context: str) -> None:
+        unit = np.asarray(vector, dtype=np.float32)
+        unit /= np.linalg.norm(unit) or 1.0
+        with self._lock:
+            self._entries[key] = (unit, context)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+kb_cache = KnowledgeCache()
 
 # ---------- SQL ----------
-db = SQLDatabase.from_uri(CONNECTION_STRING, include_tables=["devices"])
+# No SQLDatabase: it reflected the devices table through information_schema
+# on every start, and the DevicesSQLQuery description already carries the
+# schema the agent needs.
+
+# Covering indexes for the filters the agent uses most (brand/year, price)
+DEVICES_INDEXES = {
+    "devices_brand_year_idx": "ON devices (brand, release_year) INCLUDE (model, price)",
+    "devices_price_idx": "ON devices (price) INCLUDE (brand, model)",
+}
+
+
+def ensure_devices_indexes() -> None:
+    """
+    Create any missing DEVICES_INDEXES without blocking writers, then
+    refresh planner statistics so the new indexes are picked up.
+
+    A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind under
+    the same name; only valid indexes count as present, the rest are
+    dropped and rebuilt.
+    """
+    with engine.connect() as conn:
+        existing = set(
+            conn.execute(
+                text(
+                    "SELECT c.relname FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE i.indrelid = 'devices'::regclass AND i.indisvalid"
+                )
+            ).scalars()
+        )
+    missing = {
+        name: definition
+        for name, definition in DEVICES_INDEXES.items()
+        if name not in existing
+    }
+    if not missing:
+        return
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for name, definition in missing.items():
+            logger.info(f"Creating index {name}...")
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY {name} {definition}"))
+        conn.execute(text("ANALYZE devices"))
+
+
+try:
+    ensure_devices_indexes()
+except Exception as exc:
+    logger.warning(f"⚠️  Could not create devices indexes: {exc}")
+
+warm_pool()
+
+
+# Async pool for the devices SQL tool; opened and closed by main()
+_SQL_POOL = AsyncConnectionPool(PG_CONNINFO, min_size=2, max_size=8, open=False)
+
+
+# Rows handed back to the agent; anything past this is cut off
+MAX_ROWS = 50
+
+
+@lru_cache(maxsize=256)
+def _safe_select(sql: str) -> str:
+    """
+    Check that SQL is a single read-only SELECT and bound it with an outer
+    LIMIT, so no query (even one with its own or a placeholder LIMIT)
+    ever returns more than MAX_ROWS + 1 rows.
+
+    Parsed once per distinct string; ReAct loops often retry a query.
+
+    Args:
+        sql: SQL from the agent, optionally with %s placeholders
+
+    Returns:
+        The query as PostgreSQL SQL, wrapped in a bounded outer SELECT
+
+    Raises:
+        ValueError: If the input is not exactly one SELECT, modifies data,
+            selects INTO a table or locks rows
+    """
+    statements = [s for s in sqlglot.parse(sql, read="postgres") if s is not None]
+    if len(statements) != 1 or not isinstance(statements[0], exp.Select):
+        raise ValueError("only a single SELECT statement is allowed")
+    expr = statements[0]
+    if expr.find(exp.Insert, exp.Update, exp.Delete, exp.Merge):
+        raise ValueError("data-modifying statements are not allowed")
+    # SELECT ... INTO creates a table; FOR UPDATE/SHARE takes row locks
+    if any(
+        select.args.get("into") or select.args.get("locks")
+        for select in expr.find_all(exp.Select)
+    ):
+        raise ValueError("SELECT INTO and locking clauses are not allowed")
+    # One extra row lets the caller tell the agent it was truncated
+    bounded = exp.select("*").from_(expr.subquery("q")).limit(MAX_ROWS + 1)
+    return bounded.sql(dialect="postgres")
+
+
+def _format_rows(columns: list[str], rows: list[tuple], truncated: bool) -> str:
+    """Render rows as TSV with a header line."""
+    lines = ["\t".join(columns)]
+    lines.extend("\t".join(map(str, row)) for row in rows)
+    if truncated:
+        lines.append("... (truncated)")
+    return "\n".join(lines)
 
 
-def query_devices_db(sql: str) -> str:
+def _parse_sql_input(tool_input: str) -> tuple[str, list | dict]:
     """
-    Run a raw SQL query against the devices table.
+    Split tool input into SQL and params; accepts raw SQL or JSON.
+
+    params may be a list (for %s) or a dict (for %(name)s placeholders).
+    """
+    stripped = tool_input.strip()
+    if stripped.startswith("{"):
+        try:
+            payload = json.loads(stripped)
+            params = payload.get("params") or []
+            if not isinstance(params, dict):
+                params = list(params)
+            return payload["sql"].strip().rstrip(";"), params
+        except (json.JSONDecodeError, KeyError, TypeError):
+            pass
+    return stripped.rstrip(";"), []
+
+
+async def query_devices_db(sql: str) -> str:
+    """
+    Run a SQL query against the devices table without blocking the loop.
+    
+    Parametrized input ({"sql": ..., "params": [...] or {...}}) is executed
+    as a server-side prepared statement so PostgreSQL reuses the plan; raw SQL
+    is read through a server-side cursor. Anything but a single SELECT
+    is rejected before it reaches the database, every query is wrapped in
+    an outer LIMIT, and at most MAX_ROWS rows are read.
     
     Args:
-        sql: A SQL SELECT query string
+        sql: A SQL SELECT query string, or JSON with "sql" and "params"
         
     Returns:
         Formatted results or error message
     """
     logger.info(f"Executing SQL: {sql}")
     try:
-        result = db.run(sql)
+        statement, params = _parse_sql_input(sql)
+        statement = _safe_select(statement)
+        async with _SQL_POOL.connection() as conn, conn.transaction():
+            await conn.execute("SET TRANSACTION READ ONLY")
+            if params:
+                # psycopg keeps the prepared statement on the connection
+                cur = conn.cursor()
+                await cur.execute(statement, params, prepare=True)
+            else:
+                cur = conn.cursor(name="dev_stream")
+                await cur.execute(statement)
+            # A single FETCH of at most MAX_ROWS + 1 rows, never the full set
+            rows = await cur.fetchmany(MAX_ROWS + 1)
+            columns = [col.name for col in cur.description or []]
+            await cur.close()
         
-        if not result or result.strip() == "":
+        if not rows:
             return "(no rows found)"
         
-        return result
+        truncated = len(rows) > MAX_ROWS
+        return _format_rows(columns, rows[:MAX_ROWS], truncated)
     except Exception as exc:
         logger.error(f"SQL error: {exc}")
         return f"⚠️ Error executing query: {exc}"
 
 
-def retrieve_knowledge(question: str) -> str:
+def retrieve_knowledge(question: str, query_vector: list[float] | None = None) -> str:
     """
     Retrieve contextual knowledge from the vector store.
     
     Args:
         question: A natural language question or search query
+        query_vector: Precomputed embedding of question, if available
         
     Returns:
         Concatenated relevant document content
     """
     logger.info(f"Retrieving knowledge for: {question}")
+    key = kb_cache.key(question)
+    context = kb_cache.get(key)
+    if context is not None:
+        logger.info("Knowledge cache hit")
+        return context
+
     try:
-        docs = retriever.invoke(question)
+        if query_vector is None:
+            query_vector = embedding_model.embed_query(question)
+        context = kb_cache.get_similar(query_vector)
+        if context is not None:
+            logger.info("Knowledge cache hit (similar question)")
+            return context
+
+        docs = vectorstore.similarity_search_by_vector(
+            query_vector, **RETRIEVER_SEARCH_KWARGS
+        )
         
         if not docs:
             return "No relevant knowledge found in the knowledge base."
         
-        context = "\n\n---\n\n".join([doc.page_content for doc in docs])
+        if len(docs) >= KB_RERANK_MIN_DOCS:
+            docs = rerank_by_overlap(question, docs)
+        
+        # A list, not a generator: str.join materializes its input anyway
+        context = _SEP.join([doc.page_content for doc in docs])
+        kb_cache.put(key, query_vector, context)
         return context
     except Exception as exc:
         logger.error(f"Retrieval error: {exc}")
         return f"⚠️ Error retrieving knowledge: {exc}"
 
 
+async def aretrieve_knowledge(
+    question: str, query_vector: list[float] | None = None
+) -> str:
+    """Async retrieve_knowledge, so it can overlap with a SQL tool call."""
+    return await asyncio.to_thread(retrieve_knowledge, question, query_vector)
+
+
 # ---------- TOOLS ----------
-tools = [
+tools = (
     Tool(
         name="KnowledgeBaseRetriever",
         func=retrieve_knowledge,
+        coroutine=aretrieve_knowledge,
         description=(
             "Use this tool to fetch contextual information about devices, "
             "technical terms, or concepts from the knowledge base. "
@@ -192,7 +1140,8 @@ tools = [
     ),
     Tool(
         name="DevicesSQLQuery",
-        func=query_devices_db,
+        func=None,
+        coroutine=query_devices_db,
         description=(
             "Use this tool to query the PostgreSQL 'devices' table using SQL. "
             "Input MUST be a valid SQL SELECT statement. "
@@ -203,19 +1152,29 @@ tools = [
             "display_size_in, resolution, refresh_hz, battery_wh, charger_watts, "
             "psu_watts, wifi, bluetooth, weight_kg, warranty_months, price. "
             "Example: SELECT brand, model, price FROM devices WHERE brand='Samsung' AND release_year > 2021 LIMIT 10;"
+            "Prefer parametrized input as JSON with %s placeholders, e.g. "
+            '{"sql": "SELECT brand, model, price FROM devices WHERE brand = %s '
+            'AND price < %s LIMIT %s", "params": ["Samsung", 1500, 10]}. '
             "device_type can be 'Laptop', 'Desktop'."
         ),
     ),
-]
+)
+
+# Convert the tool schemas once; create_react_agent reuses a pre-bound model
+# instead of regenerating the JSON schemas itself. Ollama emits parallel
+# tool calls natively, so no parallel_tool_calls flag is bound (the ollama
+# client would reject the unknown argument).
+_BOUND_LLM = llm.bind_tools(tools)
 
 # ---------- CREATE AGENT ----------
 if USE_LANGGRAPH:
     logger.info("Creating agent using LangGraph...")
     
+    # Invoked with ainvoke: independent tool calls in one step run concurrently
     agent_executor = create_react_agent(
-        llm,
+        _BOUND_LLM,
         tools,
-    )
+    ).with_config({"run_name": "react", "recursion_limit": AGENT_RECURSION_LIMIT})
     
     logger.info("✓ Agent created successfully\n")
 else:
@@ -225,7 +1184,7 @@ else:
 
 
 # ---------- HELPER FUNCTION ----------
-def run_query(query: str, query_name: str) -> None:
+async def run_query(query: str, query_name: str) -> None:
     """Execute a query with proper error handling."""
     logger.info("=" * 80)
     logger.info(f"{query_name}: {query}")
@@ -233,8 +1192,13 @@ def run_query(query: str, query_name: str) -> None:
     
     if agent_executor:
         try:
-            # LangGraph returns a generator/stream, we need to consume it
-            result = agent_executor.invoke({"messages": [("user", query)]})
+            # LangGraph returns a generator/stream, we need to consume it;
+            # stream_mode="values" yields the state after each step, keep the last
+            result = {}
+            async for state in agent_executor.astream(
+                {"messages": [("user", query)]}, stream_mode="values"
+            ):
+                result = state
             
             # Extract the final response from messages
             if "messages" in result:
@@ -258,17 +1222,34 @@ def run_query(query: str, query_name: str) -> None:
             logger.info("Attempting SQL query...")
             # This is a simplified fallback - not as smart as an agent
             sql = "SELECT * FROM devices LIMIT 10;"
-            result = query_devices_db(sql)
+            result = await query_devices_db(sql)
             logger.info(f"\n{query_name} Result:\n{result}\n")
         
         # Try knowledge base for explanatory queries
         elif "explain" in query.lower() or "what" in query.lower():
             logger.info("Attempting knowledge retrieval...")
-            result = retrieve_knowledge(query)
+            query_vector = await asyncio.to_thread(demo_query_embed, query)
+            result = await aretrieve_knowledge(query, query_vector)
             logger.info(f"\n{query_name} Result:\n{result}\n")
 
 
 # ---------- MAIN ----------
+async def main() -> None:
+    """Run the demo queries through the agent."""
+    await _SQL_POOL.open(wait=True)
+    try:
+        # 1️⃣ Combined knowledge-base + SQL query
+        await run_query(DEMO_QUERIES[0], "🔍 Query 1")
+        
+        # 2️⃣ Purely explanatory query
+        await run_query(DEMO_QUERIES[1], "📘 Query 2")
+        
+        # 3️⃣ Complex multi-step query
+        await run_query(DEMO_QUERIES[2], "💡 Query 3")
+    finally:
+        await _SQL_POOL.close()
+
+
 if __name__ == "__main__":
     
     if not USE_LANGGRAPH:
@@ -277,25 +1258,7 @@ if __name__ == "__main__":
         logger.warning("pip install langgraph")
         logger.warning("!" * 80 + "\n")
     
-    # 1️⃣ Combined knowledge-base + SQL query
-    run_query(
-        "List all Samsung desktops released after 2021 with more than 8 CPU cores "
-        "and a price under 1500 USD.",
-        "🔍 Query 1"
-    )
-    
-    # 2️⃣ Purely explanatory query
-    run_query(
-        "Explain what CPU tier means in this dataset and how it affects performance.",
-        "📘 Query 2"
-    )
-    
-    # 3️⃣ Complex multi-step query
-    run_query(
-        "What are the top 3 most affordable laptops with at least 16GB RAM "
-        "and explain what makes a good CPU for laptops?",
-        "💡 Query 3"
-    )
+    asyncio.run(main())
     
     logger.info("=" * 80)
     logger.info("✓ All queries completed")